@@ -4,62 +4,150 @@ Tradle Hint Triangulator
 Core functions for solving Tradle puzzles using distance and direction hints.
 """
 
+import functools
+import hashlib
+import math
+import operator
+import os
+import zipfile
+
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-from scipy.spatial.distance import pdist, squareform
+
+# Natural Earth 1:110m country boundaries
+NATURAL_EARTH_URL = "https://naturalearth.s3.amazonaws.com/110m_cultural/ne_110m_admin_0_countries.zip"
+
+# Bump whenever the way centroids or distances are computed changes, so stale
+# on-disk caches are not reused
+_CACHE_VERSION = 2
+
+# Numba is optional and only used for distance matrices of at least this many
+# points. Below it the NumPy path (~2 ms for the ~177 Natural Earth countries)
+# is far cheaper than importing numba and compiling/loading its kernel (~0.5 s)
+_NUMBA_MIN_POINTS = 5000
 
 # Valid cardinal directions
 VALID_DIRECTIONS = {'N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW'}
 
+# (axis, sign) for each cardinal letter a direction can contain, where axis 0 is
+# latitude and axis 1 is longitude. A country lies in the wrong direction for a
+# letter when sign * offset <= tol, e.g. 'W' -> -(lon offset) <= tol.
+_CARDINAL_COMPONENTS = {'N': (0, 1), 'S': (0, -1), 'E': (1, 1), 'W': (1, -1)}
 
-def load_country_data():
+# Which cardinal letters each direction contains, in _CARDINAL_COMPONENTS order,
+# resolved once so hint directions are not re-parsed on every call
+_DIRECTION_CARDINALS = {
+    None: (False,) * len(_CARDINAL_COMPONENTS),
+    **{direction: tuple(c in direction for c in _CARDINAL_COMPONENTS)
+       for direction in VALID_DIRECTIONS},
+}
+
+
+def load_country_data(use_cache=True):
     """
     Load Natural Earth country data and compute centroids.
 
+    The countries, centroids and distance matrix are cached on disk (under
+    $XDG_CACHE_HOME or ~/.cache) after the first call, so later calls skip the
+    download and recomputation.
+
+    Parameters:
+        use_cache (bool): Read from and write to the on-disk cache
+
     Returns:
         tuple: (centroid_list DataFrame, distance_df DataFrame)
-            - centroid_list: DataFrame with Country and Centroid columns
+            - centroid_list: DataFrame with Country, lat and lon columns
             - distance_df: Square distance matrix between all countries
     """
+    cache_path = _cache_path()
+    data = _read_cache(cache_path) if use_cache else None
+
+    if data is None:
+        data = _compute_country_data()
+        if use_cache:
+            _write_cache(cache_path, data)
+
+    countries, lat, lon, square_distance_matrix = data
+
+    centroid_list = pd.DataFrame({'Country': countries, 'lat': lat, 'lon': lon})
+
+    # Create a DataFrame for better readability
+    distance_df = pd.DataFrame(
+        square_distance_matrix,
+        index=centroid_list['Country'],
+        columns=centroid_list['Country']
+    )
+
+    return centroid_list, distance_df
+
+
+def _compute_country_data():
+    """
+    Download Natural Earth country data and compute centroids and distances.
+
+    Returns:
+        tuple: (countries list, lat ndarray, lon ndarray, distance matrix ndarray)
+    """
     # Load Natural Earth data directly from their server
     # This avoids the deprecated geopandas.datasets module
-    url = "https://naturalearth.s3.amazonaws.com/110m_cultural/ne_110m_admin_0_countries.zip"
-    world = gpd.read_file(url)
+    world = gpd.read_file(NATURAL_EARTH_URL)
 
     # Get country centroids
     # Natural Earth data uses 'NAME' or 'ADMIN' for country names
     name_column = 'NAME' if 'NAME' in world.columns else ('ADMIN' if 'ADMIN' in world.columns else 'name')
 
     # Project to equal-area CRS for accurate centroids, then convert back to geographic
-    # EPSG:6933 is Cylindrical Equal Area, good for global centroid calculations
-    world_projected = world.to_crs(epsg=6933)
-    centroids_projected = world_projected.centroid
+    # EPSG:6933 is Cylindrical Equal Area, good for global centroid calculations.
+    # Only the geometry column is reprojected; the Natural Earth attribute
+    # columns are not needed and would otherwise be copied along
+    centroids_projected = world.geometry.to_crs(epsg=6933).centroid
     # Convert centroids back to geographic coordinates (EPSG:4326)
     centroids = centroids_projected.to_crs(epsg=4326)
 
-    centroid_list = pd.concat([world[name_column], centroids], axis=1)
-    centroid_list.columns = ['Country', 'Centroid']
+    # Keep centroids as plain float arrays rather than shapely Point objects
+    countries = world[name_column].tolist()
+    lat = centroids.y.to_numpy(dtype=np.float64)
+    lon = centroids.x.to_numpy(dtype=np.float64)
 
-    # Extract latitude and longitude from the Centroid geometry
-    centroid_coordinates = centroid_list['Centroid'].apply(
-        lambda point: (point.y, point.x)
-    ).tolist()
+    # Compute the pairwise distance matrix in one vectorized pass; float32 keeps
+    # metre-level precision at Earth-scale distances with half the memory
+    square_distance_matrix = haversine_matrix(np.column_stack([lat, lon]), dtype=np.float32)
 
-    # Compute the pairwise distance matrix using the haversine_distance function
-    distance_matrix = pdist(centroid_coordinates, metric=haversine_distance)
+    return countries, lat, lon, square_distance_matrix
 
-    # Convert to square matrix
-    square_distance_matrix = squareform(distance_matrix)
 
-    # Create a DataFrame for better readability
-    distance_df = pd.DataFrame(
-        square_distance_matrix,
-        index=centroid_list['Country'],
-        columns=centroid_list['Country']
-    )
+def _cache_path():
+    """Path of the on-disk country data cache, keyed by data source and version."""
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    key = hashlib.sha256(f"{NATURAL_EARTH_URL}|{_CACHE_VERSION}".encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'tradle_guesser', f'country_data-{key}.npz')
 
-    return centroid_list, distance_df
+
+def _read_cache(path):
+    """Return cached (countries, lat, lon, distances), or None if unavailable."""
+    try:
+        with np.load(path, allow_pickle=False) as cached:
+            return (cached['countries'].tolist(), cached['lat'], cached['lon'],
+                    cached['distances'])
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return None
+
+
+def _write_cache(path, data):
+    """Save (countries, lat, lon, distances) to the cache; failures are ignored."""
+    countries, lat, lon, distances = data
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, countries=np.array(countries, dtype=str),
+                                lat=lat, lon=lon, distances=distances)
+        # Atomic rename so concurrent readers never see a partial file
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def haversine_distance(coord1, coord2):
@@ -89,6 +177,97 @@ def haversine_distance(coord1, coord2):
     return km
 
 
+def haversine_matrix(coords, dtype=np.float64):
+    """
+    Calculate the great circle distance in kilometers between every pair of points.
+
+    Vectorized equivalent of calling haversine_distance on all pairs, without
+    a Python-level call per pair.
+
+    Parameters:
+        coords (ndarray): (N, 2) array of (latitude, longitude) in decimal degrees
+        dtype (dtype): dtype of the returned matrix; distances are computed in
+                       float64 and written into it directly
+
+    Returns:
+        ndarray: (N, N) symmetric distance matrix in kilometers
+    """
+    lat = np.radians(coords[:, 0])
+    lon = np.radians(coords[:, 1])
+
+    # Every entry is written below, so no zero-initialisation is needed
+    n = len(lat)
+    distances = np.empty((n, n), dtype=dtype)
+
+    kernel = _numba_haversine_kernel() if n >= _NUMBA_MIN_POINTS else None
+    if kernel is not None:
+        kernel(lat, lon, np.cos(lat), distances)
+        return distances
+
+    # The matrix is symmetric with a zero diagonal, so only evaluate i < j
+    i, j = np.triu_indices(n, k=1)
+
+    # Haversine in its equivalent arccos form:
+    # cos(c) = cos(dlat) - cos(lat1) * cos(lat2) * (1 - cos(dlon))
+    # This needs fewer transcendental calls and reuses the per-point cos(lat)
+    clat = np.cos(lat)
+    cos_c = np.cos(lat[j] - lat[i]) - clat[i] * clat[j] * (1 - np.cos(lon[j] - lon[i]))
+
+    # Clip guards against floating point drift just outside [-1, 1]
+    # 6,371 km is the radius of the Earth
+    d = 6371 * np.arccos(np.clip(cos_c, -1, 1))
+
+    # Mirror the upper triangle into the full square matrix
+    np.fill_diagonal(distances, 0)
+    distances[i, j] = d
+    distances[j, i] = d
+    return distances
+
+
+@functools.lru_cache(maxsize=None)
+def _numba_haversine_kernel():
+    """
+    Import numba and compile the parallel distance kernel on first use.
+
+    Returns:
+        callable: kernel(lat, lon, clat, out), or None if numba is not installed
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    # fastmath lets LLVM vectorize the inner loop's cos/acos calls; the
+    # resulting last-bit differences are far below the km precision needed here
+    @njit(parallel=True, fastmath=True, error_model='numpy', cache=True)
+    def haversine_matrix_numba(lat, lon, clat, out):
+        """
+        Fill out with the pairwise great circle distances in kilometers.
+
+        Same arccos form as haversine_matrix, but fused into a single pass over
+        the upper triangle (mirrored into the lower) with rows split across cores.
+
+        Parameters:
+            lat (ndarray): Latitudes in radians
+            lon (ndarray): Longitudes in radians
+            clat (ndarray): cos(lat), precomputed
+            out (ndarray): (N, N) output array
+        """
+        n = lat.shape[0]
+        for i in prange(n):
+            out[i, i] = 0.0
+            for j in range(i + 1, n):
+                cos_c = (math.cos(lat[j] - lat[i])
+                         - clat[i] * clat[j] * (1.0 - math.cos(lon[j] - lon[i])))
+                # Clip guards against floating point drift just outside [-1, 1]
+                cos_c = min(max(cos_c, -1.0), 1.0)
+                d = 6371.0 * math.acos(cos_c)
+                out[i, j] = d
+                out[j, i] = d
+
+    return haversine_matrix_numba
+
+
 def calculate_mismatch(guessed_country, given_distance, centroid_list, distance_df,
                        direction=None, tol=0, penalty=np.inf):
     """
@@ -98,7 +277,7 @@ def calculate_mismatch(guessed_country, given_distance, centroid_list, distance_
     Parameters:
         guessed_country (str): The name of the country that was guessed
         given_distance (float): The distance from the guessed country to the correct country
-        centroid_list (DataFrame): DataFrame with Country and Centroid columns
+        centroid_list (DataFrame): DataFrame with Country, lat and lon columns
         distance_df (DataFrame): Distance matrix between countries
         direction (str, optional): The cardinal direction in which the correct country lies
                                    Must be one of: N, NE, E, SE, S, SW, W, NW
@@ -108,6 +287,24 @@ def calculate_mismatch(guessed_country, given_distance, centroid_list, distance_
     Returns:
         Series: A Series containing the mismatch in distance for each country
 
+    Raises:
+        ValueError: If direction is invalid or country not found
+    """
+    _validate_hint(guessed_country, direction, distance_df)
+
+    mismatch = _mismatch_matrix(
+        [distance_df.index.get_loc(guessed_country)], [given_distance], [direction],
+        distance_df.to_numpy(), _direction_offsets(_ByIdentity(centroid_list), _ByIdentity(distance_df)),
+        tol=tol, penalty=penalty
+    )[0]
+
+    return pd.Series(mismatch, index=distance_df.columns, name=guessed_country).sort_values()
+
+
+def _validate_hint(guessed_country, direction, distance_df):
+    """
+    Check that a hint's country and direction are known.
+
     Raises:
         ValueError: If direction is invalid or country not found
     """
@@ -118,43 +315,90 @@ def calculate_mismatch(guessed_country, given_distance, centroid_list, distance_
     if direction is not None and direction not in VALID_DIRECTIONS:
         raise ValueError(f"Invalid direction '{direction}'. Must be one of: {sorted(VALID_DIRECTIONS)}")
 
-    # Calculate the absolute mismatch for each country
-    mismatch = distance_df.loc[guessed_country].apply(lambda x: abs(x - given_distance))
 
-    if direction:
-        # Get the latitude and longitude of the guessed country's centroid
-        guessed_coord = centroid_list.set_index('Country').loc[guessed_country, 'Centroid']
-        lat_guessed, long_guessed = guessed_coord.y, guessed_coord.x
+def _aligned_coords(centroid_list, distance_df):
+    """
+    Look up centroid coordinates for distance_df's rows and columns by country name.
+
+    Returns:
+        tuple: ((N, 2) row coords, (N, 2) column coords) as (lat, lon) in degrees
+
+    Raises:
+        ValueError: If a country in distance_df is missing from centroid_list
+    """
+    coords = centroid_list.set_index('Country')[['lat', 'lon']]
+    missing = distance_df.index.union(distance_df.columns).difference(coords.index)
+    if len(missing):
+        raise ValueError(f"Countries missing from centroid_list: {sorted(missing.tolist())}")
+
+    return (coords.loc[distance_df.index].to_numpy(),
+            coords.loc[distance_df.columns].to_numpy())
+
+
+@functools.lru_cache(maxsize=8)
+def _direction_offsets(centroid_ref, distance_ref):
+    """
+    Centroid offsets between every pair of countries, computed once per data set.
+
+    Parameters:
+        centroid_ref (_ByIdentity): Wrapped centroid_list DataFrame
+        distance_ref (_ByIdentity): Wrapped distance_df DataFrame
+
+    Returns:
+        ndarray: Read-only (2, N, N) array; [0, i, j] and [1, i, j] are the
+                 latitude and longitude (in degrees) of column j's centroid minus
+                 those of row i's centroid. Longitude offsets take the shortest
+                 way around (handle date line wrapping), in [-180, 180)
+    """
+    row_coords, col_coords = _aligned_coords(centroid_ref.obj, distance_ref.obj)
+    offsets = np.stack([
+        col_coords[None, :, 0] - row_coords[:, None, 0],
+        # Branchless modulo rather than per-element +/-360 corrections
+        np.mod(col_coords[None, :, 1] - row_coords[:, None, 1] + 180, 360) - 180,
+    ])
+    offsets.flags.writeable = False
+    return offsets
+
+
+def _mismatch_matrix(guessed_idx, given_distances, directions, dist_mat, offsets,
+                     tol=0, penalty=np.inf):
+    """
+    Array version of calculate_mismatch, evaluating K hints at once.
+
+    Parameters:
+        guessed_idx (sequence of int): Row position of each hint's guessed country
+        given_distances (sequence of float): Each hint's distance to the correct country
+        directions (sequence of str or None): Each hint's direction, or None
+        dist_mat (ndarray): (N, N) distance matrix between countries
+        offsets (ndarray): (2, N, N) lat/lon offsets from _direction_offsets
+        tol (float): Tolerance for direction filtering (degrees)
+        penalty (float): Multiplier for mismatches in wrong direction
 
-        # Filter countries based on the direction information
-        for country in centroid_list['Country']:
-            current_coord = centroid_list.set_index('Country').loc[country, 'Centroid']
-            lat_current, long_current = current_coord.y, current_coord.x
+    Returns:
+        ndarray: (K, N) mismatch in distance for each hint and country
+    """
+    guessed_idx = np.asarray(guessed_idx, dtype=np.intp)
+    given_distances = np.asarray(given_distances, dtype=np.float64)
+    # (K, 4) flags of which cardinal letters each hint's direction contains
+    applies = np.array([_DIRECTION_CARDINALS[direction] for direction in directions])
 
-            # Apply direction filters for latitude (straightforward)
-            if 'N' in direction and lat_current <= lat_guessed + tol:
-                mismatch.loc[country] *= penalty
-            if 'S' in direction and lat_current >= lat_guessed - tol:
-                mismatch.loc[country] *= penalty
+    # Calculate the absolute mismatch for each hint and country. dist_mat may be
+    # stored as float32, but the arithmetic and penalties are done in float64
+    mismatch = np.abs(dist_mat[guessed_idx].astype(np.float64) - given_distances[:, None])
 
-            # Apply direction filters for longitude (handle date line wrapping)
-            # Calculate the shortest angular difference considering wrapping
-            lon_diff = long_current - long_guessed
-            # Normalize to [-180, 180]
-            if lon_diff > 180:
-                lon_diff -= 360
-            elif lon_diff < -180:
-                lon_diff += 360
+    if applies.any():
+        # (2, K, N) offsets of every country from each guessed country's centroid
+        hint_offsets = offsets[:, guessed_idx]
 
-            if 'E' in direction and lon_diff <= tol:
-                mismatch.loc[country] *= penalty
-            if 'W' in direction and lon_diff >= -tol:
-                mismatch.loc[country] *= penalty
+        # Filter countries based on the direction information; each violated
+        # component of a hint's direction applies the penalty once
+        for k, (axis, sign) in enumerate(_CARDINAL_COMPONENTS.values()):
+            mismatch[applies[:, k, None] & (sign * hint_offsets[axis] <= tol)] *= penalty
 
-    return mismatch.sort_values()
+    return mismatch
 
 
-def best_guesses(input_list, centroid_list, distance_df, tol=0, penalty=2):
+def best_guesses(input_list, centroid_list, distance_df, tol=0, penalty=2, top_k=None):
     """
     Calculate the best guesses based on a list of hints.
 
@@ -163,40 +407,123 @@ def best_guesses(input_list, centroid_list, distance_df, tol=0, penalty=2):
             - guessed country (str)
             - given distance (float)
             - optional direction (str): e.g., 'N', 'NE', 'SW'
-        centroid_list (DataFrame): DataFrame with Country and Centroid columns
+        centroid_list (DataFrame): DataFrame with Country, lat and lon columns
         distance_df (DataFrame): Distance matrix between countries
         tol (float): Tolerance for direction filtering (degrees)
         penalty (float): Multiplier for countries in wrong direction
+        top_k (int, optional): Only return the top_k best candidates. Avoids
+                               fully sorting every country when only the head
+                               of the ranking is needed.
 
     Returns:
         DataFrame: Countries ranked by total mismatch (lower is better)
                    with column 'adjusted_km_total_error'
 
+    Results are memoized per (hints, centroid_list, distance_df, tol, penalty,
+    top_k), with the DataFrames matched by identity, so re-evaluating the same
+    hints is a cache hit. The frames from load_country_data are treated as
+    read-only; modifying them in place will not invalidate cached results.
+    The cache also keeps the frames it has seen alive (e.g. ones superseded by
+    calling load_country_data again) until their entries are evicted, as does
+    the per-data-set cache of centroid offsets; _best_guesses_cached.cache_clear()
+    and _direction_offsets.cache_clear() release them.
+
     Example:
         best_guesses([("Thailand", 7705, 'NW'), ("Eritrea", 4985)],
                      centroid_list, distance_df)
-    """
-    total_dist_errors = pd.Series(index=distance_df.index, dtype=float)
 
+    Raises:
+        ValueError: If a hint's direction is invalid or country not found,
+                    or top_k is not a non-negative integer
+    """
+    if top_k is not None:
+        try:
+            top_k_index = operator.index(top_k)
+        except TypeError:
+            top_k_index = -1
+        if top_k_index < 0:
+            raise ValueError(f"Invalid top_k {top_k!r}. Must be a non-negative integer or None")
+        top_k = top_k_index
+
+    hints = []
     for hint in input_list:
         if len(hint) == 3:
             country, dist, direction = hint
-            mismatch = calculate_mismatch(
-                country, dist, centroid_list, distance_df,
-                direction=direction, tol=tol, penalty=penalty
-            )
         else:
             country, dist = hint
-            mismatch = calculate_mismatch(
-                country, dist, centroid_list, distance_df,
-                tol=tol, penalty=penalty
-            )
+            direction = None
+        hints.append((country, float(dist), direction))
 
-        if total_dist_errors.isna().all():
-            total_dist_errors = mismatch
-        else:
-            total_dist_errors += mismatch
+    result = _best_guesses_cached(
+        tuple(hints), _ByIdentity(centroid_list), _ByIdentity(distance_df), tol, penalty, top_k
+    )
+    # Hand out a copy so callers cannot mutate the cached DataFrame
+    return result.copy()
+
+
+class _ByIdentity:
+    """Hashable wrapper comparing the wrapped (unhashable) object by identity."""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, _ByIdentity) and other.obj is self.obj
+
+
+@functools.lru_cache(maxsize=128)
+def _best_guesses_cached(hints, centroid_ref, distance_ref, tol, penalty, top_k):
+    """
+    Memoized body of best_guesses; see best_guesses for the arguments.
+
+    Parameters:
+        hints (tuple): (country, distance, direction or None) tuples
+        centroid_ref (_ByIdentity): Wrapped centroid_list DataFrame
+        distance_ref (_ByIdentity): Wrapped distance_df DataFrame
+    """
+    # The cache keeps references to the wrapped frames, so their ids cannot be
+    # reused by other objects while an entry exists
+    distance_df = distance_ref.obj
+
+    # Work on raw arrays; pandas only comes back in for the returned ranking
+    dist_mat = distance_df.to_numpy()
+    offsets = _direction_offsets(centroid_ref, distance_ref)
+
+    guessed_idx, given_distances, directions = [], [], []
+
+    for country, dist, direction in hints:
+        _validate_hint(country, direction, distance_df)
+        guessed_idx.append(distance_df.index.get_loc(country))
+        given_distances.append(dist)
+        directions.append(direction)
+
+    if guessed_idx:
+        # Score every hint in one (K, N) pass and sum over hints
+        total_dist_errors = _mismatch_matrix(
+            guessed_idx, given_distances, directions, dist_mat, offsets,
+            tol=tol, penalty=penalty
+        ).sum(axis=0)
+    else:
+        # No hints means nothing to rank
+        total_dist_errors = np.full(dist_mat.shape[1], np.nan)
+
+    total_dist_errors = pd.Series(total_dist_errors, index=distance_df.columns, dtype=float)
+    total_dist_errors = total_dist_errors.dropna()
+
+    if top_k is not None and top_k < len(total_dist_errors):
+        # Partial selection of the top_k, then sort just those
+        values = total_dist_errors.to_numpy()
+        top_idx = np.argpartition(values, top_k)[:top_k]
+        top_idx = top_idx[np.argsort(values[top_idx], kind='stable')]
+        total_dist_errors = total_dist_errors.iloc[top_idx]
+    else:
+        total_dist_errors = total_dist_errors.sort_values()
 
     # Convert to DataFrame with named column
-    result = total_dist_errors.sort_values().dropna().to_frame(name='adjusted_km_total_error')
+    result = total_dist_errors.to_frame(name='adjusted_km_total_error')
     return result